@@ -2,19 +2,64 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import copy
+import contextlib
 import gzip
+import io
+import itertools
 import json
+import math
 import os
 import shutil
 import traceback
 
+from array import array
+from collections import Counter, defaultdict
 from dataclasses import dataclass, field
-from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from operator import attrgetter, itemgetter
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 import otf2
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None  # type: ignore[assignment]
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 TIMER_GRANULARITY = int(1e9)  # chrome traces uses micro seconds but has precision up to nanoseconds in TF2!
+# Timestamps are converted to ticks inline with an integer '* 1000' because a helper call per event adds up.
+READ_BUFFER_SIZE = 4 * 1024 * 1024  # The default of 8 KiB results in many small reads from the decompressor
+EVENT_CACHE_SUFFIX = '.cache.msgpack'
+TRACE_SUFFIXES = ('.trace.json.gz', '.trace.json')
+MEMORY_PROFILE_SUFFIXES = ('.memory_profile.json.gz', '.memory_profile.json')
+NO_TIME = -1  # Marks the missing begin or end of buffered B and E events
+DURATION_EVENT_KEYS = frozenset(['ph', 'ts', 'dur', 'pid', 'tid', 'name', 'cat', 'args'])
+# The pure Python backend of ijson is much slower than loading the whole file with orjson or json,
+# so streaming is only the default with one of the compiled yajl2 backends.
+FAST_IJSON_BACKENDS = frozenset(['yajl2_c', 'yajl2_cffi'])
+# Even with those, loading the whole file at once is 2-3 times faster, but the parsed objects need several times the
+# size of the JSON in memory. So only larger files are streamed by default. Compressed traces expand about 20 times.
+LOAD_AT_ONCE_MAX_JSON_SIZE = 256 * 1024 * 1024
+GZIP_EXPANSION_ESTIMATE = 20
 
 
 @dataclass
@@ -32,17 +77,18 @@ class Process:
 
 
 @dataclass
-class DurationEvent:
-    is_begin: bool
-
-    time: int  # ticks in TIMER_GRANULARITY
-    pid: int
-    tid: int
+class ThreadDurationEvents:
+    """
+    The buffered duration events of one thread in trace order. All events have to be buffered until the whole trace
+    has been read, so they are stored column-wise in arrays of machine integers instead of one object per event.
+    X events and matched B/E pairs set both times. A B event without an E event stores NO_TIME as its end, an E event
+    without a B event stores NO_TIME as its begin.
+    """
 
-    # These are optional in the chrome trace format, in which case they will be empty left empty
-    name: str
-    category: str
-    args: Dict[str, Any]
+    name_ids: array = field(default_factory=lambda: array('l'))  # Index into ChromeTrace2OTF2._name_ids
+    begins: array = field(default_factory=lambda: array('q'))  # ticks in TIMER_GRANULARITY
+    ends: array = field(default_factory=lambda: array('q'))  # ticks in TIMER_GRANULARITY
+    open_begins: List[int] = field(default_factory=list)  # Stack of indexes of B events still waiting for their E
 
 
 @dataclass
@@ -53,21 +99,135 @@ class Communicator:
 
 
 def is_gzip_file(path):
+    with open(path, 'rb') as file:
+        return file.read(2) == b'\x1f\x8b'
+
+
+def iterate_files(directory: str) -> Iterator[os.DirEntry]:
+    """
+    Yields the files in the directory and, recursively, in its subdirectories like os.walk would, but without building
+    the file and directory name lists. The entries from os.scandir already know whether they are directories, so this
+    needs no extra stat call per entry except for symbolic links. Like os.walk, directories which cannot be listed are
+    skipped.
+    """
     try:
-        file = gzip.open(path)
-        file.read(1)
-        return True
-    except Exception:
+        scandir_iterator = os.scandir(directory)
+    except OSError:
+        return
+
+    subdirectories = []
+    with scandir_iterator as entries:
+        for entry in entries:
+            if entry.is_dir():
+                # Symbolic links to directories are neither files nor followed, like in os.walk.
+                if not entry.is_symlink():
+                    subdirectories.append(entry.path)
+            else:
+                yield entry
+    for subdirectory in subdirectories:
+        yield from iterate_files(subdirectory)
+
+
+def open_maybe_gzip(path: str) -> io.BufferedIOBase:
+    """Opens the file for reading in binary mode and transparently decompresses it if it is gzip-compressed."""
+    if not is_gzip_file(path):
+        return open(path, 'rb')
+    if rapidgzip is not None:
+        # Decompresses the file in parallel on all cores
+        return io.BufferedReader(rapidgzip.open(path, parallelization=os.cpu_count()), buffer_size=READ_BUFFER_SIZE)
+    if igzip is not None:
+        # Drop-in replacement for gzip, which decompresses single-threaded but with the SIMD-optimized ISA-L
+        return io.BufferedReader(igzip.open(path, 'rb'), buffer_size=READ_BUFFER_SIZE)
+    return io.BufferedReader(gzip.open(path, 'rb'), buffer_size=READ_BUFFER_SIZE)
+
+
+def load_json(json_file: io.BufferedIOBase) -> Any:
+    """Parses the whole JSON file at once. Uses orjson if available because it is several times faster than json."""
+    if orjson is not None:
+        return orjson.loads(json_file.read())
+    return json.load(json_file)
+
+
+def should_stream_json(path: str) -> bool:
+    """Decides whether to parse the JSON file incrementally if the user did not choose it explicitly."""
+    if ijson is None or ijson.backend not in FAST_IJSON_BACKENDS:
         return False
+    json_size = os.path.getsize(path)
+    if is_gzip_file(path):
+        json_size *= GZIP_EXPANSION_ESTIMATE
+    return json_size > LOAD_AT_ONCE_MAX_JSON_SIZE
+
+
+def iterate_trace_events(json_file: io.BufferedIOBase, stream: bool) -> Iterable[Dict]:
+    """
+    Returns an iterable over the "traceEvents" list of a chrome trace. If stream is set, the events are
+    parsed incrementally with ijson so that only the currently processed event has to be held in memory
+    instead of the whole trace, which can be several GB large.
+    """
+    if stream:
+        return ijson.items(json_file, 'traceEvents.item', use_float=True)
+    return load_json(json_file)['traceEvents']
+
+
+def iterate_cached_trace_events(trace_path: str, stream: bool) -> Iterator[Dict]:
+    """
+    Yields the trace events from a msgpack cache next to the trace, which is much faster to decode than JSON. If the
+    cache is missing or older than the trace, the events are parsed from the trace and written to the cache on the fly.
+    """
+    cache_path = trace_path + EVENT_CACHE_SUFFIX
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(trace_path):
+        with open(cache_path, 'rb') as cache_file:
+            yield from msgpack.Unpacker(cache_file, raw=False)
+        return
+
+    # Write to a temporary file first so that an interrupted conversion does not leave an incomplete cache behind
+    temporary_path = cache_path + '.tmp'
+    try:
+        with open_maybe_gzip(trace_path) as json_file, open(temporary_path, 'wb') as cache_file:
+            packer = msgpack.Packer()
+            for event in iterate_trace_events(json_file, stream):
+                cache_file.write(packer.pack(event))
+                yield event
+    except BaseException:
+        # The temporary file does not exist yet if opening the trace failed
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary_path)
+        raise
+    os.replace(temporary_path, cache_path)
+
+
+def iterate_allocator_profiles(json_file: io.BufferedIOBase, stream: bool) -> Iterable[Tuple[str, Dict]]:
+    """
+    Returns an iterable over the (allocator name, profile) pairs of a TensorFlow memory profile. Like the trace
+    events, these are parsed incrementally per allocator if stream is set.
+    """
+    if stream:
+        return ijson.kvitems(json_file, 'memoryProfilePerAllocator', use_float=True)
+    return load_json(json_file)['memoryProfilePerAllocator'].items()
 
 
 class ChromeTrace2OTF2:
-    def __init__(self, input_path: str, memory_profile_path: Optional[str] = None) -> None:
+    def __init__(
+        self,
+        input_path: str,
+        memory_profile_path: Optional[str] = None,
+        excluded_categories: Optional[Iterable[str]] = None,
+        use_event_cache: bool = False,
+        stream: Optional[bool] = None,
+    ) -> None:
         """
         input_path : A path to a folder containing a "<hostname>.memory_profile.json.gz" and
                      "<hostname>.trace.json.gz" or path to the latter directly.
         memory_profile_path : Path to the "<hostname>.memory_profile.json.gz". If input_path
                      is a folder and this is not set, then search in the folder for this file.
+        excluded_categories : Events with one of these categories, e.g., "python_function", are
+                     dropped right after parsing and not converted. Events with multiple
+                     categories are dropped if any of them is excluded.
+        use_event_cache : Store the parsed trace events in "<trace>.cache.msgpack" and read them from
+                     there in subsequent conversions as long as the trace has not been modified.
+        stream : Parse the JSON files incrementally with ijson instead of loading them at once, which
+                     needs much less memory. By default, this is done for large files if ijson has a
+                     compiled backend.
         """
 
         if not input_path or not os.path.exists(input_path):
@@ -76,33 +236,44 @@ class ChromeTrace2OTF2:
         if memory_profile_path and not os.path.exists(memory_profile_path):
             raise Exception("Specified memory profile location does not exist:", memory_profile_path)
 
+        if use_event_cache and msgpack is None:
+            raise Exception("The event cache requires the msgpack module!")
+
+        if stream and ijson is None:
+            raise Exception("Streaming the JSON files requires the ijson module!")
+
         self._trace_file: Optional[str] = None
         self._memory_trace_file = memory_profile_path
+        self._excluded_categories = frozenset(excluded_categories or [])
+        self._use_event_cache = use_event_cache
+        self._stream = stream
 
         if os.path.isfile(input_path):
             self._trace_file = input_path
         elif os.path.isdir(input_path):
-            for root, _, files in os.walk(input_path):
-                for filename in files:
-                    if filename.endswith('.trace.json.gz') or filename.endswith('.trace.json'):
-                        if self._trace_file is None:
-                            self._trace_file = os.path.join(root, filename)
-                        else:
-                            raise Exception("Found multiple chrome traces. Please specify the file or folder directly!")
-
-                    if filename.endswith('.memory_profile.json.gz') or filename.endswith('.memory_profile.json'):
-                        if self._memory_trace_file is None:
-                            self._memory_trace_file = os.path.join(root, filename)
-                        else:
-                            raise Exception(
-                                "Found multiple memory profiles. Please specify the file or folder directly!"
-                            )
+            # The search can not stop at the first trace because the whole folder has to be checked for a second one.
+            # A memory profile given explicitly takes precedence over the ones in the folder.
+            search_memory_profile = self._memory_trace_file is None
+            for entry in iterate_files(input_path):
+                if entry.name.endswith(TRACE_SUFFIXES):
+                    if self._trace_file is None:
+                        self._trace_file = entry.path
+                    else:
+                        raise Exception("Found multiple chrome traces. Please specify the file or folder directly!")
+
+                elif search_memory_profile and entry.name.endswith(MEMORY_PROFILE_SUFFIXES):
+                    if self._memory_trace_file is None:
+                        self._memory_trace_file = entry.path
+                    else:
+                        raise Exception("Found multiple memory profiles. Please specify the file or folder directly!")
 
         if not self._trace_file:
             raise Exception("No chrome trace found")
 
         self._process_map: Dict[int, Process] = {}
         self._function_map: Dict[str, otf2.definitions.Region] = {}
+        # Maps each distinct duration event name to the ID under which it is buffered, in order of appearance
+        self._name_ids: Dict[str, int] = {}
         self._metric_map: Dict[str, otf2.definitions.Metric] = {}
         self._dataflow_start: Dict[str, Any] = {}
         self._communicators: List[Communicator] = []
@@ -141,8 +312,10 @@ class ChromeTrace2OTF2:
             ')': self._handle_context_leave,
         }
 
-        self._duration_events: List[DurationEvent] = []
+        # Duration events per (pid, tid), kept in the order in which they appear in the trace
+        self._duration_events: Dict[Tuple[int, int], ThreadDurationEvents] = defaultdict(ThreadDurationEvents)
         self._flow_events: List[Tuple[Dict, Dict]] = []
+        self._unhandled_event_counts: Counter[Tuple[str, str]] = Counter()
         self._location_events: Dict[otf2.definitions.Location, List[otf2.events._Event]] = {}
 
     def convert_trace(self, output_dir: str) -> None:
@@ -155,54 +328,76 @@ class ChromeTrace2OTF2:
             self._otf2_root_node = otf2_trace.definitions.system_tree_node("root node")
             self._otf2_system_tree_host = otf2_trace.definitions.system_tree_node("myHost", parent=self._otf2_root_node)
 
-            with gzip.open(self._trace_file, 'rb') if is_gzip_file(self._trace_file) else open(
-                self._trace_file, 'rb'
-            ) as json_file:
-                chrome_data = json.load(json_file)
-                self._convert_event_trace(chrome_data, otf2_trace)
+            stream = self._stream_json(self._trace_file)
+            if self._use_event_cache:
+                self._convert_event_trace(iterate_cached_trace_events(self._trace_file, stream), otf2_trace)
+            else:
+                with open_maybe_gzip(self._trace_file) as json_file:
+                    self._convert_event_trace(iterate_trace_events(json_file, stream), otf2_trace)
 
             if self._memory_trace_file:
-                with gzip.open(self._memory_trace_file, 'rb') if is_gzip_file(self._memory_trace_file) else open(
-                    self._memory_trace_file, 'rb'
-                ) as json_file:
-                    memory_data = json.load(json_file)
-                    self._convert_memory_profile(memory_data, otf2_trace)
-
-    def _convert_event_trace(self, chrome_data: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        self._duration_events = []
+                with open_maybe_gzip(self._memory_trace_file) as json_file:
+                    self._convert_memory_profile(
+                        iterate_allocator_profiles(json_file, self._stream_json(self._memory_trace_file)), otf2_trace
+                    )
+
+    def _stream_json(self, path: str) -> bool:
+        return should_stream_json(path) if self._stream is None else self._stream
+
+    def _convert_event_trace(self, events: Iterable[Dict], otf2_trace: otf2.writer.Writer) -> None:
+        self._duration_events = defaultdict(ThreadDurationEvents)
         self._flow_events = []
-        for event in chrome_data['traceEvents']:
+        self._unhandled_event_counts = Counter()
+        phase_handlers = self._phase_handlers
+        excluded_categories = self._excluded_categories
+        for event in events:
             if not event:
                 # Trace might contain an empty event at the end for some reason
                 continue
 
-            for key in ['ts', 'dur']:
-                if key in event:
-                    event[key] = int(event[key])
-
-            phase = event['ph']
-            if phase in self._phase_handlers:
+            if excluded_categories:
+                # 'cat' is a comma-separated list of categories, but usually consists of only one.
+                category = event.get('cat')
+                if category in excluded_categories or (
+                    category and ',' in category and not excluded_categories.isdisjoint(category.split(','))
+                ):
+                    continue
+
+            # Some traces store the timestamp as a string. It is converted exactly once here, so the handlers can rely
+            # on an integer. 'dur' is only needed for complete events and converted there.
+            timestamp = event.get('ts')
+            if timestamp is not None:
+                event['ts'] = int(timestamp)
+
+            handler = phase_handlers.get(event.get('ph', ''))
+            if handler is not None:
                 try:
-                    self._phase_handlers[phase](event, otf2_trace)
+                    handler(event, otf2_trace)
                 except Exception as exception:
                     print("Trying to process event raised an exception:")
                     print("    Event:", event)
                     print("    Exception:", exception)
                     traceback.print_exc()
             else:
-                print(f"Unknown event found: {event}")
-
-        for event in sorted(self._duration_events, key=lambda e: e.time):
-            if event.name not in self._function_map:
-                self._otf2_add_function(event.name, otf2_trace)
-            otf2_function = self._function_map[event.name]
-
-            location = self._get_location(event.pid, event.tid, otf2_trace).location
+                self._report_unhandled("Unknown event found:", event)
+        self._print_unhandled_summary()
+
+        # No global sort by time is necessary because OTF2 only requires monotonic timestamps per location. The duration
+        # events are sorted per thread, which usually is one location. Only locations shared by several threads, e.g.,
+        # threads with the same name, and locations receiving flow events have to be sorted again afterwards.
+        # Define all regions up front so that the loop below can look them up by name ID.
+        otf2_functions = [
+            self._function_map[name] if name in self._function_map else self._otf2_add_function(name, otf2_trace)
+            for name in self._name_ids
+        ]
 
-            self._location_events[location].append(
-                otf2.events.Enter(event.time, otf2_function)
-                if event.is_begin
-                else otf2.events.Leave(event.time, otf2_function)
+        unsorted_locations: Set[otf2.definitions.Location] = set()
+        for (pid, tid), thread_duration_events in self._duration_events.items():
+            location = self._get_location(pid, tid, otf2_trace).location
+            if self._location_events[location]:
+                unsorted_locations.add(location)
+            self._location_events[location].extend(
+                self._sorted_otf2_duration_events(thread_duration_events, otf2_functions)
             )
 
         # Collect all OTF2 locations participating in flow events and create a COMM_LOCATIONS group containing
@@ -228,10 +423,12 @@ class ChromeTrace2OTF2:
                 otf2_trace,
             )
             otf2_communicator = communicator.communicator
+            unsorted_locations.add(send_location.location)
+            unsorted_locations.add(recv_location.location)
 
             self._location_events[send_location.location].append(
                 otf2.events.MpiSend(
-                    self._convert_time_to_ticks(int(send_event['ts'])),
+                    send_event['ts'] * 1000,
                     otf2_communicator.rank(recv_location.location),
                     otf2_communicator,
                     int(send_event['id']),
@@ -241,7 +438,7 @@ class ChromeTrace2OTF2:
 
             self._location_events[recv_location.location].append(
                 otf2.events.MpiRecv(
-                    self._convert_time_to_ticks(int(receive_event['ts'])),
+                    receive_event['ts'] * 1000,
                     otf2_communicator.rank(send_location.location),
                     otf2_communicator,
                     int(receive_event['id']),
@@ -249,101 +446,164 @@ class ChromeTrace2OTF2:
                 )
             )
 
-        for location, events in self._location_events.items():
-            writer = otf2_trace.event_writer_from_location(location)
-            for event in sorted(events, key=lambda e: e.time):
-                writer.write(event)
+        # The OTF2 bindings have no call to write multiple events at once, so at least write all events of one location
+        # in a tight loop and release them right afterwards.
+        for location, location_events in self._location_events.items():
+            write = otf2_trace.event_writer_from_location(location).write
+            if location in unsorted_locations:
+                location_events.sort(key=attrgetter('time'))
+            for event in location_events:
+                write(event)
+            location_events.clear()
 
     @staticmethod
-    def _convert_duration_event(event: Dict) -> DurationEvent:
-        if event['ph'] not in ['B', 'E']:
-            raise ValueError("May only be constructed from chrome trace duration events!")
-
-        for key in event.keys():
-            if key not in ['ph', 'ts', 'pid', 'tid', 'name', 'cat', 'args']:
-                print("Ignoring unknown event key:", key)
-
-        return DurationEvent(
-            is_begin=event['ph'] == 'B',
-            time=int(event['ts']),
-            pid=int(event['pid']),
-            tid=int(event['tid']),
-            # Optional arguments
-            name=event['name'] if 'name' in event else "",
-            category=event['cat'] if 'cat' in event else "",
-            args=event['args'] if 'args' in event else {},
-        )
-
-    def _convert_memory_profile(self, memory_data: Dict, otf2_trace: otf2.writer.Writer) -> None:
+    def _sorted_otf2_duration_events(
+        thread_duration_events: ThreadDurationEvents, otf2_functions: List[otf2.definitions.Region]
+    ) -> Iterator[otf2.events._Event]:
+        """
+        Splits the buffered duration events of one thread into OTF2 enter and leave events and sorts them by time.
+        otf2_functions maps the name IDs to the regions, so the thread and the regions are resolved only once.
+        """
+        # This is the innermost loop over all duration events, so module and attribute lookups are bound to locals.
+        enter = otf2.events.Enter
+        leave = otf2.events.Leave
+
+        # Entries are (time, is_enter, -end or -begin, ±index, event). Sorting by these keys keeps a valid nesting for
+        # events with equal timestamps: Leaves come before enters, the innermost region is left first and the
+        # outermost is entered first. Regions with equal times are nested in trace order, i.e., they are entered in
+        # trace order and left in reverse. An unmatched B event is still open at the end of the trace and an unmatched E
+        # event began before its start, so they are entered first and left last respectively. Among themselves, they
+        # keep their trace order.
+        timeline: List[Tuple[int, bool, float, int, otf2.events._Event]] = []
+        append = timeline.append
+        for index, (name_id, begin, end) in enumerate(
+            zip(thread_duration_events.name_ids, thread_duration_events.begins, thread_duration_events.ends)
+        ):
+            otf2_function = otf2_functions[name_id]
+            if begin == NO_TIME:
+                append((end, False, math.inf, index, leave(end, otf2_function)))
+            elif end == NO_TIME:
+                append((begin, True, -math.inf, index, enter(begin, otf2_function)))
+            else:
+                append((begin, True, -end, index, enter(begin, otf2_function)))
+                if begin == end:
+                    # A zero-duration leave gets the same keys as its enter so that the stable sort keeps it right
+                    # behind it.
+                    append((begin, True, -end, index, leave(end, otf2_function)))
+                else:
+                    append((end, False, -begin, -index, leave(end, otf2_function)))
+        timeline.sort(key=itemgetter(0, 1, 2, 3))
+        return map(itemgetter(4), timeline)
+
+    def _buffer_duration_event(self, event: Dict, begin: int, end: int) -> ThreadDurationEvents:
+        """
+        Buffers a duration event (B, E) or a complete event (X) for its thread without copying it. The times in ticks
+        are passed separately because they are derived differently for each phase. Only the handlers of these phases
+        call this, so the phase is not checked again for every event. Returns the buffer of the thread.
+        """
+        self._check_duration_event_keys(event)
+
+        name_ids = self._name_ids
+        name = event.get('name', "")
+        name_id = name_ids.get(name)
+        if name_id is None:
+            name_id = name_ids[name] = len(name_ids)
+
+        thread_duration_events = self._duration_events[(int(event['pid']), int(event['tid']))]
+        thread_duration_events.name_ids.append(name_id)
+        thread_duration_events.begins.append(begin)
+        thread_duration_events.ends.append(end)
+        return thread_duration_events
+
+    def _check_duration_event_keys(self, event: Dict) -> None:
+        # Checking the keys in place is much cheaper than building their difference set, which is rarely non-empty.
+        if not DURATION_EVENT_KEYS.issuperset(event):
+            for key in event.keys() - DURATION_EVENT_KEYS:
+                self._report_unhandled(f"Ignoring unknown event key '{key}':", event)
+
+    def _convert_memory_profile(
+        self, allocator_profiles: Iterable[Tuple[str, Dict]], otf2_trace: otf2.writer.Writer
+    ) -> None:
         otf2_location_group = otf2_trace.definitions.location_group(
             "TF Memory Allocators", system_tree_parent=self._otf2_system_tree_host
         )
 
-        memory_activities = {}
-        otf2_attributes = {}
-        uint_metadata = [  # These are some values which are strings in the JSON even though they are integers
-            "stackReservedBytes",
-            "heapAllocatedBytes",
-            "freeMemoryBytes",
-            "peakBytesInUse",
-            "requestedBytes",
-            "allocationBytes",
-            "address",
-            "stepId",
-        ]
-
-        last_leave = None
+        memory_activities: Dict[str, otf2.definitions.Region] = {}
+        otf2_attributes: Dict[str, otf2.definitions.Attribute] = {}
+        # These are some values which are strings in the JSON even though they are integers
+        uint_metadata = frozenset(
+            [
+                "stackReservedBytes",
+                "heapAllocatedBytes",
+                "freeMemoryBytes",
+                "peakBytesInUse",
+                "requestedBytes",
+                "allocationBytes",
+                "address",
+                "stepId",
+            ]
+        )
 
-        for allocator_name, profile in memory_data['memoryProfilePerAllocator'].items():
+        # The allocators are independent of each other but converting them in parallel would not pay off: building the
+        # attributes is pure Python code holding the GIL, and the OTF2 definitions can not be shared with other
+        # processes. Each allocator is written to its own location, so its last activity has to be left there, too.
+        for allocator_name, profile in allocator_profiles:
             location_writer = otf2_trace.event_writer(allocator_name, group=otf2_location_group)
+            last_leave = None
 
             for snapshot in profile['memoryProfileSnapshots']:
                 activity = snapshot['activityMetadata']['memoryActivity']
-                if activity not in memory_activities:
-                    memory_activities[activity] = otf2_trace.definitions.region(activity, paradigm=otf2.Paradigm.USER)
-
-                event_attributes = copy.deepcopy(snapshot['activityMetadata'])
-                event_attributes.update(snapshot['aggregationStats'])
+                activity_region = memory_activities.get(activity)
+                if activity_region is None:
+                    activity_region = otf2_trace.definitions.region(activity, paradigm=otf2.Paradigm.USER)
+                    memory_activities[activity] = activity_region
 
                 otf2_event_attributes = {}
 
-                for key, value in event_attributes.items():
-                    if key not in otf2_attributes:
+                # The values are primitives, so both dicts can be iterated directly instead of merging a copy of them.
+                for key, value in itertools.chain(
+                    snapshot['activityMetadata'].items(), snapshot['aggregationStats'].items()
+                ):
+                    if key in uint_metadata:
+                        value = int(value)
+
+                    # The type of an attribute does not change between snapshots, so it is only determined once.
+                    otf2_attribute = otf2_attributes.get(key)
+                    if otf2_attribute is None:
                         attribute_type = otf2.Type.STRING
                         if key in uint_metadata:
-                            value = int(value)
                             attribute_type = otf2.Type.UINT64
-                        elif key is isinstance(value, int):
-                            attribute_type = otf2.Type.INT64
-                        elif key is isinstance(value, float):
+                        elif isinstance(value, bool):
+                            attribute_type = otf2.Type.UINT8
+                        elif isinstance(value, (int, float)):
+                            # Other numbers, e.g., "fragmentation", may be integral in the first snapshot but
+                            # fractional in later ones, which an integer attribute would silently truncate.
                             attribute_type = otf2.Type.DOUBLE
 
-                        otf2_attributes[key] = otf2_trace.definitions.attribute(name=key, type=attribute_type)
+                        otf2_attribute = otf2_trace.definitions.attribute(name=key, type=attribute_type)
+                        otf2_attributes[key] = otf2_attribute
 
-                    otf2_event_attributes[otf2_attributes[key]] = value
+                    otf2_event_attributes[otf2_attribute] = value
 
                 timestamp = int(snapshot['timeOffsetPs']) // 1000  # Time is in picoseconds but precision is nanoseconds
                 if last_leave:  # Put the leave at the next enter in order to not create invisible metrics and regions
                     location_writer.leave(timestamp, region=last_leave)
-                location_writer.enter(timestamp, memory_activities[activity], attributes=otf2_event_attributes)
-                last_leave = memory_activities[activity]
-
-        if last_leave:
-            location_writer.leave(timestamp, region=last_leave)
+                location_writer.enter(timestamp, activity_region, attributes=otf2_event_attributes)
+                last_leave = activity_region
 
-    @staticmethod
-    def _convert_time_to_ticks(timestamp: float) -> int:
-        """Converts microseconds with 3 decimal places for nanoseconds to nanoseconds (integer)"""
-        return int(timestamp * 1e3)
+            if last_leave:
+                location_writer.leave(timestamp, region=last_leave)
 
     def _get_location(self, pid: int, tid: int, otf2_trace: otf2.writer.Writer) -> Location:
-        if pid not in self._process_map:
-            self._otf2_add_process(pid, otf2_trace, self._otf2_system_tree_host)
+        process = self._process_map.get(pid)
+        if process is None:
+            process = self._otf2_add_process(pid, otf2_trace, self._otf2_system_tree_host)
 
-        if tid not in self._process_map[pid].threads:
-            self._otf2_add_thread(tid, pid, otf2_trace)
+        thread = process.threads.get(tid)
+        if thread is None:
+            thread = self._otf2_add_thread(tid, pid, otf2_trace)
 
-        return self._process_map[pid].threads[tid]
+        return thread
 
     def _get_location_from_event(self, event: Dict, otf2_trace: otf2.writer.Writer) -> Location:
         return self._get_location(int(event['pid']), int(event['tid']), otf2_trace)
@@ -367,70 +627,98 @@ class ChromeTrace2OTF2:
         self._communicators.append(Communicator(name, members, communicator))
         return self._communicators[-1]
 
+    def _report_unhandled(self, message: str, event: Dict) -> None:
+        """
+        Prints the message with the event only for the first event of its phase with this message. Traces can contain
+        millions of events which are not converted, so the others are only counted and summarized at the end.
+        """
+        key = (message, event.get('ph', ''))
+        count = self._unhandled_event_counts[key] + 1
+        self._unhandled_event_counts[key] = count
+        if count == 1:
+            print(message, event)
+
+    def _print_unhandled_summary(self) -> None:
+        for (message, phase), count in self._unhandled_event_counts.items():
+            if count > 1:
+                print(f"{message.rstrip(':')}: {count} events with phase '{phase}' in total")
+
     # Event handlers for every phase
 
     def _handle_deprecated(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        print("Unhandled deprecated event", event)
+        self._report_unhandled("Unhandled deprecated event", event)
 
     def _handle_duration_begin_end(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        event['ts'] = ChromeTrace2OTF2._convert_time_to_ticks(int(event['ts']))
-        self._duration_events.append(self._convert_duration_event(event))
+        time = event['ts'] * 1000
+        if event['ph'] == 'B':
+            thread_duration_events = self._buffer_duration_event(event, time, NO_TIME)
+            thread_duration_events.open_begins.append(len(thread_duration_events.begins) - 1)
+            return
+
+        # B and E events on one thread have to be properly nested, so an E event ends the most recent open B event.
+        # Storing both times in one entry lets the pair be sorted like an X event. The leave also gets the region of
+        # the B event even if the E event has no name.
+        thread_duration_events = self._duration_events[(int(event['pid']), int(event['tid']))]
+        if thread_duration_events.open_begins:
+            self._check_duration_event_keys(event)
+            thread_duration_events.ends[thread_duration_events.open_begins.pop()] = time
+        else:
+            self._buffer_duration_event(event, NO_TIME, time)
 
     def _handle_complete(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
         # Complete Events, TensorFlow seems to not use B and E events in an attempt to reduce the trace file size.
-        # Split these complete events into enter/leave events in order to sort them by timestamp.
+        # These are buffered as a single record and only split into enter/leave events when they are written.
         # A special case might be X and B,E events being used in the same trace.
-        if 'ts' not in event:
+        timestamp = event.get('ts')
+        if timestamp is None:
             raise KeyError("Required ts is missing in the given event!")
 
-        enter_event = copy.deepcopy(event)
-        del enter_event['dur']
-        enter_event['ph'] = 'B'
+        # The default is only created if needed, unlike with event.get('args', {}), which builds it for every event.
+        args = event.get('args') or {}
+
         # Try to get more time precision from rocprof-specific data in args
-        if 'args' in event and 'BeginNs' in event['args']:
-            enter_event['ts'] = event['args']['BeginNs']
+        begin_ns = args.get('BeginNs')
+        if begin_ns is not None:
+            begin = int(begin_ns)
         else:
-            enter_event['ts'] = ChromeTrace2OTF2._convert_time_to_ticks(int(event['ts']))
+            begin = timestamp * 1000
 
-        leave_event = copy.deepcopy(event)
-        del leave_event['dur']
-        leave_event['ph'] = 'E'
         # Try to get more time precision from rocprof-specific data in args
-        if 'args' in event and 'EndNs' in event['args']:
-            leave_event['ts'] = event['args']['EndNs']
+        end_ns = args.get('EndNs')
+        if end_ns is not None:
+            end = int(end_ns)
         else:
             # dur key is only optional but I've yet to see a case where it isn't set.
-            duration = int(event['dur']) if 'dur' in event else 0
-            leave_event['ts'] = ChromeTrace2OTF2._convert_time_to_ticks(int(event['ts']) + duration)
+            end = (timestamp + int(event.get('dur', 0))) * 1000
 
-        self._duration_events.append(self._convert_duration_event(enter_event))
-        self._duration_events.append(self._convert_duration_event(leave_event))
+        self._buffer_duration_event(event, begin, end)
 
     def _handle_instant(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
         # E.g., with a kineto pytorch trace, these are generated for memory accesses
         # This would map well to a counter
         # However, in general, these are more like samples
-        print("Unhandled event", event)
+        self._report_unhandled("Unhandled event", event)
 
     # TODO Map newly created processes for only collecting one metric to process with same name
     def _handle_counter(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
         metric_name = event['name']
         if metric_name == 'Allocated Bytes':
-            if metric_name not in self._metric_map:
-                self.otf2_add_metric(otf2_trace, metric_name, 'Bytes')
+            metric = self._metric_map.get(metric_name)
+            if metric is None:
+                metric = self.otf2_add_metric(otf2_trace, metric_name, 'Bytes')
 
             metric_value = event['args']['Allocator Bytes in Use']
             writer = self._get_location_from_event(event, otf2_trace).writer
-            writer.metric(self._convert_time_to_ticks(event['ts']), self._metric_map[metric_name], metric_value)
+            writer.metric(event['ts'] * 1000, metric, metric_value)
 
     def _handle_async_nestable_start(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        print("Unhandled event", event)
+        self._report_unhandled("Unhandled event", event)
 
     def _handle_async_nestable_instant(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        print("Unhandled event", event)
+        self._report_unhandled("Unhandled event", event)
 
     def _handle_async_nestable_end(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        print("Unhandled event", event)
+        self._report_unhandled("Unhandled event", event)
 
     # TODO implementation of dataflow
     def _handle_flow_start(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
@@ -456,19 +744,19 @@ class ChromeTrace2OTF2:
         self._dataflow_start = {}
 
     def _handle_flow_end(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        print("Unhandled event", event)
+        self._report_unhandled("Unhandled event", event)
 
     def _handle_sample(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        print("Unhandled event", event)
+        self._report_unhandled("Unhandled event", event)
 
     def _handle_object_create(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        print("Unhandled event", event)
+        self._report_unhandled("Unhandled event", event)
 
     def _handle_object_snapshot(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        print("Unhandled event", event)
+        self._report_unhandled("Unhandled event", event)
 
     def _handle_object_destroy(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        print("Unhandled event", event)
+        self._report_unhandled("Unhandled event", event)
 
     def _handle_metadata(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
         if 'name' not in event:
@@ -491,44 +779,36 @@ class ChromeTrace2OTF2:
             ), "The thread_name metadata event should be the very first event for that thread!"
             self._otf2_add_thread(tid, pid, otf2_trace, name)
 
-        elif event_type == 'process_labels':
-            labels = event['args']['labels']
-            print("Unhandled metadata event type:", event_type, labels)
-
-        elif event_type == 'process_sort_index:':
-            sort_index = event['sort_index']['labels']
-            print("Unhandled metadata event type:", event_type, sort_index)
-
-        elif event_type == 'thread_sort_index:':
-            sort_index = event['sort_index']['labels']
-            print("Unhandled metadata event type:", event_type, sort_index)
+        elif event_type in ('process_labels', 'process_sort_index', 'thread_sort_index'):
+            self._report_unhandled(f"Unhandled metadata event type {event_type}:", event)
 
         else:
-            print("Unknown metadata event:", event)
+            self._report_unhandled(f"Unknown metadata event {event_type}:", event)
 
     def _handle_memory_dump_global(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        print("Unhandled event", event)
+        self._report_unhandled("Unhandled event", event)
 
     def _handle_memory_dump_process(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        print("Unhandled event", event)
+        self._report_unhandled("Unhandled event", event)
 
     def _handle_mark(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        print("Unhandled event", event)
+        self._report_unhandled("Unhandled event", event)
 
     def _handle_clock_sync(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        print("Unhandled event", event)
+        self._report_unhandled("Unhandled event", event)
 
     def _handle_context_enter(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        print("Unhandled event", event)
+        self._report_unhandled("Unhandled event", event)
 
     def _handle_context_leave(self, event: Dict, otf2_trace: otf2.writer.Writer) -> None:
-        print("Unhandled event", event)
+        self._report_unhandled("Unhandled event", event)
 
     # OTF2 Helpers to Add Defintiions
 
-    def otf2_add_metric(self, otf2_trace: otf2.writer.Writer, name: str, unit: str) -> None:
+    def otf2_add_metric(self, otf2_trace: otf2.writer.Writer, name: str, unit: str) -> otf2.definitions.Metric:
         metric = otf2_trace.definitions.metric(name, unit=unit)
         self._metric_map[name] = metric
+        return metric
 
     def _otf2_add_process(
         self,
@@ -536,36 +816,40 @@ class ChromeTrace2OTF2:
         otf2_trace: otf2.writer.Writer,
         otf2_system_tree_node: otf2.definitions.SystemTreeNode,
         name: Optional[str] = None,
-    ) -> None:
+    ) -> Process:
         process_name = name if name else str(pid)
         otf2_location_group = otf2_trace.definitions.location_group(
             process_name, system_tree_parent=otf2_system_tree_node
         )
 
-        if pid in self._process_map:
-            process = self._process_map[pid]
+        process = self._process_map.get(pid)
+        if process is None:
+            process = Process(name=process_name, group=otf2_location_group)
+            self._process_map[pid] = process
+        else:
             process.group = otf2_location_group
             process.name = process_name
-        else:
-            self._process_map[pid] = Process(name=process_name, group=otf2_location_group)
+        return process
 
-    def _otf2_add_thread(self, tid: int, pid: int, otf2_trace: otf2.writer.Writer, name: Optional[str] = None) -> None:
+    def _otf2_add_thread(
+        self, tid: int, pid: int, otf2_trace: otf2.writer.Writer, name: Optional[str] = None
+    ) -> Location:
         process = self._process_map[pid]
         thread_name = name if name else f"{process.name} {tid}"
 
-        location = Location(
-            thread_name,
-            otf2_trace.event_writer(thread_name, group=process.group),
-            otf2_trace.definitions.location(thread_name, group=process.group),
-        )
+        # Define the location only once. otf2_trace.event_writer would create an equal definition a second time, which
+        # is then deduplicated again.
+        otf2_location = otf2_trace.definitions.location(thread_name, group=process.group)
+        location = Location(thread_name, otf2_trace.event_writer_from_location(otf2_location), otf2_location)
 
         process.threads[tid] = location
-        if location.location not in self._location_events:
-            self._location_events[location.location] = []
+        self._location_events.setdefault(location.location, [])
+        return location
 
-    def _otf2_add_function(self, name: str, otf2_trace: otf2.writer.Writer) -> None:
+    def _otf2_add_function(self, name: str, otf2_trace: otf2.writer.Writer) -> otf2.definitions.Region:
         otf2_function = otf2_trace.definitions.region(name, paradigm=otf2.Paradigm.USER)
         self._function_map[name] = otf2_function
+        return otf2_function
 
 
 def cli():
@@ -590,13 +874,34 @@ def cli():
         action="store_true",
         help="Clean (delete) the output folder if it exists",
     )
+    parser.add_argument(
+        "--exclude-cat",
+        action="append",
+        default=[],
+        metavar="CATEGORY",
+        help="Drop events with this category, e.g., python_function, while parsing. Can be given multiple times",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Cache the parsed trace events next to the chrome tracing file to speed up repeated conversions",
+    )
+    parser.add_argument(
+        "--stream",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Parse the JSON files incrementally with ijson instead of loading them into memory at once "
+        "(default: only for large files and if ijson has a compiled backend)",
+    )
     args = parser.parse_args()
 
     out_folder = args.output
     if args.clean and os.path.exists(out_folder):
         shutil.rmtree(out_folder)
 
-    converter = ChromeTrace2OTF2(args.input)
+    converter = ChromeTrace2OTF2(
+        args.input, excluded_categories=args.exclude_cat, use_event_cache=args.cache, stream=args.stream
+    )
     converter.convert_trace(out_folder)
 
 
@@ -4,9 +4,12 @@
 # pylint: disable=wrong-import-position
 # pylint: disable=protected-access
 
+import json
 import os
+import shutil
 import sys
 
+import otf2
 import pytest
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -22,3 +25,231 @@ def test_conversion(tmpdir, trace_name):
     output_folder = os.path.join(tmpdir, trace_name)
     ChromeTrace2OTF2(input_file).convert_trace(output_folder)
     assert os.path.exists(os.path.join(output_folder, "traces.otf2"))
+
+
+def test_excluded_categories(tmpdir):
+    input_file = os.path.join(os.path.dirname(__file__), "data", "memcpy-host-device.rocprofiler.json.gz")
+    output_folder = os.path.join(tmpdir, "excluded")
+    ChromeTrace2OTF2(input_file, excluded_categories=["DataFlow"]).convert_trace(output_folder)
+
+    with otf2.reader.open(os.path.join(output_folder, "traces.otf2")) as trace:
+        event_types = {type(event) for _, event in trace.events}
+    assert otf2.events.Enter in event_types
+    assert otf2.events.MpiSend not in event_types
+
+    # Events can have multiple comma-separated categories.
+    events = [
+        {"ph": "X", "name": "kept", "cat": "foo", "pid": 1, "tid": 1, "ts": 0, "dur": 1},
+        {"ph": "X", "name": "dropped", "cat": "python_function,foo", "pid": 1, "tid": 1, "ts": 1, "dur": 1},
+        {"ph": "X", "name": "dropped", "cat": "python_function", "pid": 1, "tid": 1, "ts": 2, "dur": 1},
+    ]
+    input_file = write_trace(tmpdir, events)
+    output_folder = os.path.join(tmpdir, "excluded_multiple")
+    ChromeTrace2OTF2(input_file, excluded_categories=["python_function"]).convert_trace(output_folder)
+
+    with otf2.reader.open(os.path.join(output_folder, "traces.otf2")) as trace:
+        assert {event.region.name for _, event in trace.events} == {"kept"}
+
+
+def test_event_cache(tmpdir):
+    pytest.importorskip("msgpack")
+    input_file = os.path.join(tmpdir, "memcpy-host-device.rocprofiler.json.gz")
+    shutil.copy(os.path.join(os.path.dirname(__file__), "data", "memcpy-host-device.rocprofiler.json.gz"), input_file)
+
+    event_counts = []
+    for run in range(2):
+        output_folder = os.path.join(tmpdir, f"run{run}")
+        ChromeTrace2OTF2(input_file, use_event_cache=True).convert_trace(output_folder)
+        assert os.path.exists(input_file + ".cache.msgpack")
+        with otf2.reader.open(os.path.join(output_folder, "traces.otf2")) as trace:
+            event_counts.append(sum(1 for _ in trace.events))
+    assert event_counts[0] == event_counts[1] > 0
+
+
+def write_trace(tmpdir, events):
+    input_file = os.path.join(tmpdir, "host.trace.json")
+    with open(input_file, 'w', encoding='utf-8') as file:
+        json.dump({"traceEvents": events}, file)
+    return input_file
+
+
+def check_region_nesting(output_folder):
+    call_stacks = {}
+    with otf2.reader.open(os.path.join(output_folder, "traces.otf2")) as trace:
+        for location, event in trace.events:
+            call_stack = call_stacks.setdefault(location, [])
+            if isinstance(event, otf2.events.Enter):
+                call_stack.append(event.region)
+            elif isinstance(event, otf2.events.Leave):
+                assert call_stack and call_stack.pop() == event.region
+    assert all(not call_stack for call_stack in call_stacks.values())
+
+
+def test_region_nesting(tmpdir):
+    # The trace contains regions which start or end at the same time as their parent region.
+    input_file = os.path.join(os.path.dirname(__file__), "data", "memcpy-host-device.rocprofiler.json.gz")
+    output_folder = os.path.join(tmpdir, "nesting")
+    ChromeTrace2OTF2(input_file).convert_trace(output_folder)
+    check_region_nesting(output_folder)
+
+    # B/E pairs mixed with X events, a zero-length B/E pair and an E event without a name.
+    events = [
+        {"ph": "B", "name": "A", "pid": 1, "tid": 1, "ts": 0},
+        {"ph": "E", "name": "A", "pid": 1, "tid": 1, "ts": 10},
+        {"ph": "X", "name": "B", "pid": 1, "tid": 1, "ts": 10, "dur": 5},
+        {"ph": "B", "name": "C", "pid": 1, "tid": 1, "ts": 15},
+        {"ph": "B", "name": "D", "pid": 1, "tid": 1, "ts": 15},
+        {"ph": "E", "pid": 1, "tid": 1, "ts": 15},
+        {"ph": "X", "name": "E", "pid": 1, "tid": 1, "ts": 15, "dur": 5},
+        {"ph": "E", "pid": 1, "tid": 1, "ts": 20},
+    ]
+    input_file = write_trace(tmpdir, events)
+    output_folder = os.path.join(tmpdir, "mixed_nesting")
+    ChromeTrace2OTF2(input_file).convert_trace(output_folder)
+    check_region_nesting(output_folder)
+
+    # A truncated trace: The B event on thread 1 never ends and the E event on thread 2 has no B event.
+    events = [
+        {"ph": "B", "name": "outer", "pid": 1, "tid": 1, "ts": 0},
+        {"ph": "X", "name": "inner", "pid": 1, "tid": 1, "ts": 0, "dur": 5},
+        {"ph": "X", "name": "inner", "pid": 1, "tid": 2, "ts": 0, "dur": 5},
+        {"ph": "E", "name": "outer", "pid": 1, "tid": 2, "ts": 5},
+    ]
+    input_file = write_trace(tmpdir, events)
+    output_folder = os.path.join(tmpdir, "truncated_nesting")
+    ChromeTrace2OTF2(input_file).convert_trace(output_folder)
+    location_events = {}
+    with otf2.reader.open(os.path.join(output_folder, "traces.otf2")) as trace:
+        for location, event in trace.events:
+            location_events.setdefault(location.name, []).append((type(event).__name__, event.region.name))
+    assert sorted(location_events.values()) == [
+        [("Enter", "inner"), ("Leave", "inner"), ("Leave", "outer")],
+        [("Enter", "outer"), ("Enter", "inner"), ("Leave", "inner")],
+    ]
+
+
+def test_duplicate_thread_names(tmpdir):
+    # Threads with the same name share one OTF2 location, so their events have to be merged by time.
+    events = [{"ph": "M", "name": "thread_name", "pid": 1, "tid": tid, "args": {"name": "worker"}} for tid in (1, 2)]
+    events += [
+        {"ph": "X", "name": "first", "pid": 1, "tid": 1, "ts": 10, "dur": 5},
+        {"ph": "X", "name": "second", "pid": 1, "tid": 2, "ts": 0, "dur": 5},
+    ]
+    input_file = write_trace(tmpdir, events)
+
+    output_folder = os.path.join(tmpdir, "duplicate_thread_names")
+    ChromeTrace2OTF2(input_file).convert_trace(output_folder)
+    with otf2.reader.open(os.path.join(output_folder, "traces.otf2")) as trace:
+        assert [event.time for _, event in trace.events] == [0, 5000, 10000, 15000]
+
+
+def test_explicit_memory_profile(tmpdir):
+    input_file = os.path.join(os.path.dirname(__file__), "data", "memcpy-host-device.rocprofiler.json.gz")
+    shutil.copy(input_file, os.path.join(tmpdir, "host.trace.json.gz"))
+    memory_profiles = [os.path.join(tmpdir, f"host{i}.memory_profile.json") for i in range(2)]
+    for memory_profile in memory_profiles:
+        with open(memory_profile, 'w', encoding='utf-8') as file:
+            file.write('{"memoryProfilePerAllocator": {}}')
+
+    with pytest.raises(Exception, match="multiple memory profiles"):
+        ChromeTrace2OTF2(str(tmpdir))
+
+    converter = ChromeTrace2OTF2(str(tmpdir), memory_profile_path=memory_profiles[1])
+    assert converter._memory_trace_file == memory_profiles[1]
+
+
+def test_directory_symlinks(tmpdir):
+    input_file = os.path.join(os.path.dirname(__file__), "data", "memcpy-host-device.rocprofiler.json.gz")
+    shutil.copy(input_file, os.path.join(tmpdir, "host.trace.json.gz"))
+    os.mkdir(os.path.join(tmpdir, "real"))
+    os.symlink(os.path.join(tmpdir, "real"), os.path.join(tmpdir, "link.memory_profile.json"))
+
+    converter = ChromeTrace2OTF2(str(tmpdir))
+    assert converter._memory_trace_file is None
+
+
+def test_streaming(tmpdir):
+    pytest.importorskip("ijson")
+    input_file = os.path.join(os.path.dirname(__file__), "data", "memcpy-host-device.rocprofiler.json.gz")
+
+    events = []
+    for stream in [False, True]:
+        output_folder = os.path.join(tmpdir, f"stream{stream}")
+        ChromeTrace2OTF2(input_file, stream=stream).convert_trace(output_folder)
+        with otf2.reader.open(os.path.join(output_folder, "traces.otf2")) as trace:
+            events.append([(type(event), event.time) for _, event in trace.events])
+    assert events[0] == events[1]
+
+
+def test_unhandled_events_summary(tmpdir, capsys):
+    events = [{"ph": "X", "name": "op", "pid": 1, "tid": 1, "ts": 0, "dur": 1}]
+    events += [{"ph": "i", "name": "instant", "pid": 1, "tid": 1, "ts": ts} for ts in range(3)]
+    input_file = write_trace(tmpdir, events)
+
+    ChromeTrace2OTF2(input_file).convert_trace(os.path.join(tmpdir, "unhandled"))
+    output = capsys.readouterr().out
+    assert output.count("'name': 'instant'") == 1
+    assert "Unhandled event: 3 events with phase 'i' in total" in output
+
+
+def test_memory_profile(tmpdir):
+    def snapshot(time_offset_ps, activity, fragmentation):
+        return {
+            "timeOffsetPs": str(time_offset_ps),
+            "activityMetadata": {"memoryActivity": activity, "requestedBytes": "8", "tfOpName": "op"},
+            "aggregationStats": {"fragmentation": fragmentation, "peakBytesInUse": "64", "isCompacted": False},
+        }
+
+    memory_profile = os.path.join(tmpdir, "host.memory_profile.json")
+    with open(memory_profile, 'w', encoding='utf-8') as file:
+        snapshots = [
+            snapshot(1000, "ALLOCATION", 0),
+            snapshot(2000, "DEALLOCATION", 0.5),
+            snapshot(3000, "ALLOCATION", 0.25),
+        ]
+        json.dump({"memoryProfilePerAllocator": {"GPU_0_bfc": {"memoryProfileSnapshots": snapshots}}}, file)
+
+    input_file = os.path.join(os.path.dirname(__file__), "data", "memcpy-host-device.rocprofiler.json.gz")
+
+    def convert(stream):
+        output_folder = os.path.join(tmpdir, f"memory{stream}")
+        ChromeTrace2OTF2(input_file, memory_profile_path=memory_profile, stream=stream).convert_trace(output_folder)
+        with otf2.reader.open(os.path.join(output_folder, "traces.otf2")) as trace:
+            return [
+                (
+                    type(event),
+                    event.time,
+                    {attribute.name: value for attribute, value in (event.attributes or {}).items()},
+                )
+                for location, event in trace.events
+                if location.name == "GPU_0_bfc"
+            ]
+
+    allocator_events = convert(stream=False)
+    enter_attributes = [attributes for event_type, _, attributes in allocator_events if event_type == otf2.events.Enter]
+
+    assert [event_type for event_type, _, _ in allocator_events] == [otf2.events.Enter, otf2.events.Leave] * 3
+    assert [attributes["fragmentation"] for attributes in enter_attributes] == [0, 0.5, 0.25]
+    assert enter_attributes[0]["requestedBytes"] == 8
+    assert enter_attributes[0]["peakBytesInUse"] == 64
+    assert enter_attributes[0]["isCompacted"] == 0
+    assert enter_attributes[0]["tfOpName"] == "op"
+
+    # The memory profile is small enough to be loaded at once by default, so also check the streamed parsing.
+    pytest.importorskip("ijson")
+    assert convert(stream=True) == allocator_events
+
+
+def test_event_cache_unreadable_trace(tmpdir):
+    pytest.importorskip("msgpack")
+    input_file = os.path.join(tmpdir, "host.trace.json")
+    with open(input_file, 'w', encoding='utf-8') as file:
+        file.write('{"traceEvents": [')
+
+    converter = ChromeTrace2OTF2(input_file, use_event_cache=True, stream=False)
+    # Opening the trace fails after the cache has been checked, but before the temporary cache file is created.
+    os.remove(input_file)
+    os.mkdir(input_file)
+    with pytest.raises(IsADirectoryError):
+        converter.convert_trace(os.path.join(tmpdir, "unreadable"))
+    assert not os.path.exists(input_file + ".cache.msgpack.tmp")